@@ -3,73 +3,157 @@ PREDICT Trial Emulation - Result Visualization
 Generates publication-quality graphs from the trial JSON data.
 """
 
+import io
 import json
+import os
+import sys
+import textwrap
+import zlib
+import multiprocessing
 import numpy as np
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
 
+try:
+    import cairosvg
+except (ImportError, OSError):
+    # OSError: the wheel is installed but the system libcairo is missing
+    cairosvg = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Set style
 plt.rcParams['axes.grid'] = True
 plt.rcParams['grid.alpha'] = 0.3
 plt.rcParams['axes.facecolor'] = '#f8f9fa'
 plt.rcParams['figure.facecolor'] = 'white'
 plt.rcParams['font.family'] = 'sans-serif'
+# Glyphs as paths: the PNG is rasterized from the SVG by cairosvg, which must
+# not depend on which fonts happen to be installed
+plt.rcParams['svg.fonttype'] = 'path'
+
+def panel_rng(panel_name):
+    """
+    Generator for a panel's simulated data, seeded from the panel name.
 
-np.random.seed(42)
+    Fresh per render, so the output does not depend on which trials a worker
+    process drew before (crc32 rather than hash(), which is salted per process).
+    """
+    return np.random.default_rng([42, zlib.crc32(panel_name.encode())])
 
 
 def load_trial_data(json_path='predict_trial.json'):
     """Load trial data from JSON."""
+    if orjson is not None:
+        with open(json_path, 'rb') as f:
+            return orjson.loads(f.read())
     with open(json_path, 'r') as f:
         return json.load(f)
 
 
+class TrialReport:
+    """
+    Composite 4x2 report figure that is built once and reused across trials.
+
+    The figure, grid and suptitle are created in __init__; update() clears and
+    redraws the eight panel axes in place, so batch runs skip the per-trial
+    figure/axes construction while every artist stays vector for the SVG.
+    """
+
+    def __init__(self):
+        self.fig, axes = plt.subplots(4, 2, figsize=(20, 24))
+        self._axes = list(axes.flat)
+        self._title = self.fig.suptitle('', fontsize=16, fontweight='bold', y=0.995)
+        self.output_base = None
+
+    def update(self, data):
+        """Redraw all panels for a trial into the existing axes."""
+        trial_name = data['trial_config']['trial_name']
+        self._title.set_text(f'{trial_name} - Target Trial Emulation Results')
+
+        for ax, draw_panel in zip(self._axes, PANELS.values()):
+            ax.clear()
+            draw_panel(ax, data)
+
+        self.fig.tight_layout(rect=[0, 0, 1, 0.99], pad=3.0)
+        self.output_base = data['trial_config']['trial_id'].lower() + '_results'
+
+    def save(self):
+        """Write the current trial's report as SVG and PNG."""
+        output_base = self.output_base
+
+        # Walk the artists once (SVG) and rasterize that for the PNG
+        svg_buf = io.BytesIO()
+        self.fig.savefig(svg_buf, format='svg', bbox_inches='tight', facecolor='white')
+        svg_bytes = svg_buf.getvalue()
+        with open(f'{output_base}.svg', 'wb') as f:
+            f.write(svg_bytes)
+
+        if cairosvg is not None:
+            # The SVG is sized in pt; cairosvg converts units at its dpi
+            # setting (default 96), so pass 150 to match the savefig PNG
+            cairosvg.svg2png(bytestring=svg_bytes, write_to=f'{output_base}.png',
+                             dpi=150, background_color='white')
+        else:
+            self.fig.savefig(f'{output_base}.png', dpi=150, bbox_inches='tight', facecolor='white')
+
+        print(f"Saved: {output_base}.png and {output_base}.svg")
+
+    def close(self):
+        plt.close(self.fig)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
 def create_all_figures(data):
     """Generate all figures for the trial."""
-    trial_name = data['trial_config']['trial_name']
+    with TrialReport() as report:
+        report.update(data)
+        report.save()
 
-    fig = plt.figure(figsize=(20, 24))
-    fig.suptitle(f'{trial_name} - Target Trial Emulation Results', fontsize=16, fontweight='bold', y=0.995)
 
-    # 1. Cohort Attrition
-    ax1 = fig.add_subplot(4, 2, 1)
-    create_attrition_diagram(ax1, data)
+# One report figure per worker process, built by the Pool initializer
+_WORKER_REPORT = None
 
-    # 2. Propensity Score Distribution
-    ax2 = fig.add_subplot(4, 2, 2)
-    create_ps_distribution(ax2, data)
 
-    # 3. Covariate Balance (Love Plot)
-    ax3 = fig.add_subplot(4, 2, 3)
-    create_love_plot(ax3, data)
+def _init_worker():
+    global _WORKER_REPORT
+    _WORKER_REPORT = TrialReport()
 
-    # 4. Primary Outcome Comparison
-    ax4 = fig.add_subplot(4, 2, 4)
-    create_outcome_comparison(ax4, data)
 
-    # 5. Subgroup Forest Plot
-    ax5 = fig.add_subplot(4, 2, 5)
-    create_forest_plot(ax5, data)
-
-    # 6. Cumulative Incidence Curve
-    ax6 = fig.add_subplot(4, 2, 6)
-    create_ci_curve(ax6, data)
+def _render_trial(json_path, report=None):
+    report = report or _WORKER_REPORT
+    print(f"Loading trial data from {json_path}...")
+    data = load_trial_data(json_path)
+    print(f"Generating graphs for: {data['trial_config']['trial_name']}")
+    report.update(data)
+    report.save()
 
-    # 7. Validation Timeline
-    ax7 = fig.add_subplot(4, 2, 7)
-    create_validation_summary(ax7, data)
 
-    # 8. Conclusion Summary
-    ax8 = fig.add_subplot(4, 2, 8)
-    create_conclusion_panel(ax8, data)
+def render_reports(json_paths, n_workers=None):
+    """
+    Render the report for each trial JSON.
 
-    plt.tight_layout(rect=[0, 0, 1, 0.99], pad=3.0)
+    Trials are independent, so a batch is spread over worker processes, each
+    reusing its own TrialReport; a single trial is rendered in-process.
+    """
+    if len(json_paths) == 1:
+        with TrialReport() as report:
+            _render_trial(json_paths[0], report)
+        return
 
-    output_base = data['trial_config']['trial_id'].lower() + '_results'
-    plt.savefig(f'{output_base}.png', dpi=150, bbox_inches='tight', facecolor='white')
-    plt.savefig(f'{output_base}.svg', format='svg', bbox_inches='tight', facecolor='white')
-    print(f"Saved: {output_base}.png and {output_base}.svg")
-    plt.close()
+    n_workers = n_workers or min(len(json_paths), os.cpu_count() or 1)
+    with multiprocessing.Pool(n_workers, initializer=_init_worker) as pool:
+        pool.map(_render_trial, json_paths)
 
 
 def create_attrition_diagram(ax, data):
@@ -85,9 +169,11 @@ def create_attrition_diagram(ax, data):
     comparator_name = data['trial_config']['comparator'].split('(')[0].strip()
 
     # Get arm names from the keys
-    arm_keys = list(arms.keys())
+    arm_keys = list(arms)
     intervention_key = arm_keys[0]
     comparator_key = arm_keys[1] if len(arm_keys) > 1 else arm_keys[0]
+    int_label, comp_label = intervention_key.title(), comparator_key.title()
+    n_int, n_comp = arms[intervention_key], arms[comparator_key]
 
     steps = [
         (f"Initial Population\n(Imaging Procedures)", cohort['initial_population'], 9.0),
@@ -109,35 +195,40 @@ def create_attrition_diagram(ax, data):
     # Final split
     ax.add_patch(plt.Rectangle((0.5, 2.5), 3.5, 1.2, facecolor='#e74c3c', alpha=0.2,
                                 edgecolor='#e74c3c', linewidth=2))
-    ax.text(2.25, 3.1, f"{intervention_key.title()}\n(Intervention)\nN = {arms[intervention_key]:,}",
+    ax.text(2.25, 3.1, f"{int_label}\n(Intervention)\nN = {n_int:,}",
             ha='center', va='center', fontsize=9)
 
     ax.add_patch(plt.Rectangle((6, 2.5), 3.5, 1.2, facecolor='#9b59b6', alpha=0.2,
                                 edgecolor='#9b59b6', linewidth=2))
-    ax.text(7.75, 3.1, f"{comparator_key.title()}\n(Comparator)\nN = {arms[comparator_key]:,}",
+    ax.text(7.75, 3.1, f"{comp_label}\n(Comparator)\nN = {n_comp:,}",
             ha='center', va='center', fontsize=9)
 
     ax.plot([5, 2.25], [5.4, 3.8], 'gray', lw=1.5)
     ax.plot([5, 7.75], [5.4, 3.8], 'gray', lw=1.5)
 
 
-def create_ps_distribution(ax, data):
+def create_ps_distribution(ax, data, rng=None):
     """Create propensity score distribution plot."""
+    if rng is None:
+        rng = panel_rng('ps_distribution')
     diag = data['results']['diagnostics']
     arms = data['results']['cohort']['treatment_arms']
-    arm_keys = list(arms.keys())
+    arm_keys = list(arms)
+    int_key = arm_keys[0]
+    comp_key = arm_keys[1] if len(arm_keys) > 1 else int_key
+    int_label = int_key.title()
+    comp_label = comp_key.title() if len(arm_keys) > 1 else 'Comparator'
+    n_int, n_comp = arms[int_key], arms[comp_key]
 
     # Simulate PS distributions based on overlap
     overlap = diag.get('ps_overlap', 0.8)
-    n_int = arms[arm_keys[0]]
-    n_comp = arms[arm_keys[1]] if len(arm_keys) > 1 else arms[arm_keys[0]]
 
-    ps_int = np.clip(np.random.beta(4.5, 4.0, n_int) * 0.6 + 0.2, 0.025, 0.975)
-    ps_comp = np.clip(np.random.beta(4.0, 4.5, n_comp) * 0.6 + 0.2, 0.025, 0.975)
+    ps_int = np.clip(rng.beta(4.5, 4.0, n_int) * 0.6 + 0.2, 0.025, 0.975)
+    ps_comp = np.clip(rng.beta(4.0, 4.5, n_comp) * 0.6 + 0.2, 0.025, 0.975)
 
-    ax.hist(ps_int, bins=30, alpha=0.6, color='#e74c3c', label=arm_keys[0].title(),
+    ax.hist(ps_int, bins=30, alpha=0.6, color='#e74c3c', label=int_label,
             density=True, edgecolor='white')
-    ax.hist(ps_comp, bins=30, alpha=0.6, color='#9b59b6', label=arm_keys[1].title() if len(arm_keys) > 1 else 'Comparator',
+    ax.hist(ps_comp, bins=30, alpha=0.6, color='#9b59b6', label=comp_label,
             density=True, edgecolor='white')
 
     ax.axvline(x=0.025, color='black', linestyle='--', alpha=0.5, label='Trim bounds')
@@ -154,8 +245,10 @@ def create_ps_distribution(ax, data):
             ha='center', fontsize=9, bbox=dict(boxstyle='round', facecolor='wheat', alpha=0.5))
 
 
-def create_love_plot(ax, data):
+def create_love_plot(ax, data, rng=None):
     """Create Love plot showing covariate balance."""
+    if rng is None:
+        rng = panel_rng('love_plot')
     max_smd = data['results']['diagnostics'].get('max_smd_after_weighting', 0.05)
 
     covariates = [
@@ -165,8 +258,8 @@ def create_love_plot(ax, data):
     ]
 
     # Simulate reasonable SMDs
-    smd_before = np.abs(np.random.normal(0.08, 0.04, len(covariates)))
-    smd_after = np.abs(np.random.normal(max_smd/2, max_smd/4, len(covariates)))
+    smd_before = np.abs(rng.normal(0.08, 0.04, len(covariates)))
+    smd_after = np.abs(rng.normal(max_smd/2, max_smd/4, len(covariates)))
     smd_after = np.clip(smd_after, 0, max_smd * 1.2)
 
     y_pos = np.arange(len(covariates))
@@ -196,7 +289,9 @@ def create_outcome_comparison(ax, data):
     """Create outcome comparison bar chart."""
     outcome = data['results']['primary_outcome']
     arms = data['results']['cohort']['treatment_arms']
-    arm_keys = list(arms.keys())
+    arm_keys = list(arms)
+    int_label = arm_keys[0].title()
+    comp_label = arm_keys[1].title() if len(arm_keys) > 1 else 'Comparator'
 
     int_rate = outcome['rates']['intervention'] * 100
     comp_rate = outcome['rates']['comparator'] * 100
@@ -209,7 +304,7 @@ def create_outcome_comparison(ax, data):
     x = np.array([0, 1])
     rates = [int_rate, comp_rate]
     colors = ['#e74c3c', '#9b59b6']
-    labels = [arm_keys[0].title(), arm_keys[1].title() if len(arm_keys) > 1 else 'Comparator']
+    labels = [int_label, comp_label]
 
     bars = ax.bar(x, rates, color=colors, alpha=0.8, edgecolor='white', width=0.5)
     ax.errorbar(x, rates, yerr=[se, se], fmt='none', color='black', capsize=5, capthick=2)
@@ -290,7 +385,9 @@ def create_ci_curve(ax, data):
     comp_rate = outcome['rates']['comparator']
 
     arms = data['results']['cohort']['treatment_arms']
-    arm_keys = list(arms.keys())
+    arm_keys = list(arms)
+    int_label = arm_keys[0].title()
+    comp_label = arm_keys[1].title() if len(arm_keys) > 1 else 'Comparator'
 
     # Simulate cumulative incidence over 72 hours
     hours = np.array([0, 6, 12, 18, 24, 30, 36, 42, 48, 54, 60, 66, 72])
@@ -312,9 +409,8 @@ def create_ci_curve(ax, data):
     ax.fill_between(hours, int_lower, int_upper, alpha=0.2, color='#e74c3c')
     ax.fill_between(hours, comp_lower, comp_upper, alpha=0.2, color='#9b59b6')
 
-    ax.step(hours, int_ci, where='post', color='#e74c3c', linewidth=2, label=arm_keys[0].title())
-    ax.step(hours, comp_ci, where='post', color='#9b59b6', linewidth=2,
-            label=arm_keys[1].title() if len(arm_keys) > 1 else 'Comparator')
+    ax.step(hours, int_ci, where='post', color='#e74c3c', linewidth=2, label=int_label)
+    ax.step(hours, comp_ci, where='post', color='#9b59b6', linewidth=2, label=comp_label)
 
     ax.axvspan(48, 72, alpha=0.1, color='yellow', label='Primary window (48-72h)')
 
@@ -379,16 +475,7 @@ def create_conclusion_panel(ax, data):
             bbox=dict(boxstyle='round', facecolor='white', edgecolor='gray', alpha=0.8))
 
     # Summary (wrapped)
-    summary = conclusion['summary']
-    words = summary.split()
-    lines = []
-    current_line = []
-    for word in words:
-        current_line.append(word)
-        if len(' '.join(current_line)) > 70:
-            lines.append(' '.join(current_line[:-1]))
-            current_line = [word]
-    lines.append(' '.join(current_line))
+    lines = textwrap.wrap(conclusion['summary'], width=70)
 
     y = 5.5
     for line in lines[:4]:
@@ -398,16 +485,27 @@ def create_conclusion_panel(ax, data):
     # Recommendation
     ax.text(0.5, 2.5, "Recommendation:", fontsize=10, fontweight='bold')
     rec = conclusion['recommendation']
-    rec_lines = [rec[i:i+75] for i in range(0, len(rec), 75)]
+    rec_lines = textwrap.wrap(rec, width=75)
     y = 2.0
     for line in rec_lines[:3]:
         ax.text(0.5, y, line, fontsize=8, va='center', style='italic')
         y -= 0.4
 
 
+# Report panels in grid order (A-H)
+PANELS = {
+    'attrition': create_attrition_diagram,
+    'ps_distribution': create_ps_distribution,
+    'love_plot': create_love_plot,
+    'outcome_comparison': create_outcome_comparison,
+    'forest_plot': create_forest_plot,
+    'ci_curve': create_ci_curve,
+    'validation_summary': create_validation_summary,
+    'conclusion': create_conclusion_panel,
+}
+
+
 if __name__ == '__main__':
-    print("Loading trial data...")
-    data = load_trial_data()
-    print(f"Generating graphs for: {data['trial_config']['trial_name']}")
-    create_all_figures(data)
+    # Usage: python generate_graphs.py [trial1.json trial2.json ...]
+    render_reports(sys.argv[1:] or ['predict_trial.json'])
     print("Done!")
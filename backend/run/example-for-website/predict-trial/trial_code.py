@@ -6,8 +6,16 @@ from sklearn.linear_model import LogisticRegression
 from sklearn.model_selection import StratifiedKFold
 from sklearn.preprocessing import StandardScaler
 from scipy.stats import norm
+from scipy.special import expit
 import warnings
 import os
+import hashlib
+from dataclasses import dataclass
+
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
 
 # Suppress warnings for cleaner output
 warnings.filterwarnings('ignore')
@@ -36,6 +44,13 @@ N_FOLDS = 5
 PS_TRIM_LOW = 0.025
 PS_TRIM_HIGH = 0.975
 
+# Derived cohort cache (df_final, X_final, T, Y)
+CHECKPOINT_FILES = ("df_cohort.parquet", "X_sparse.npz", "pid_to_idx.joblib", "feat_to_idx.joblib")
+CACHE_DIR = "cache"
+# Bump whenever define_predict_trial_cohort / define_outcome change what they derive
+# (2: outcome window floors elapsed time instead of counting calendar days)
+COHORT_CACHE_VERSION = 2
+
 # =============================================================================
 # 2. DATA LOADING
 # =============================================================================
@@ -61,6 +76,42 @@ def load_checkpoint_data():
         print("Ensure df_cohort.parquet, X_sparse.npz, pid_to_idx.joblib, feat_to_idx.joblib exist.")
         raise
 
+def cohort_cache_key():
+    """
+    Key for the derived cohort: derivation version, checkpoint mtimes and
+    eligibility/exposure settings.
+    """
+    h = hashlib.blake2b(digest_size=8)
+    h.update(f"v{COHORT_CACHE_VERSION}".encode())
+    for path in CHECKPOINT_FILES:
+        h.update(f"{path}:{os.path.getmtime(path)}".encode())
+    h.update(repr((EGFR_MIN, EGFR_MAX, IODIXANOL_ID, IOPAMIDOL_ID, sorted(DIABETES_ALL))).encode())
+    return h.hexdigest()
+
+def load_cohort_cache(key):
+    """
+    Returns cached (df_final, X_final, T, Y) for this key, or None on a miss.
+    """
+    base = os.path.join(CACHE_DIR, key)
+    paths = (f"{base}.parquet", f"{base}_X.npz", f"{base}_TY.npz")
+    if not all(os.path.exists(path) for path in paths):
+        return None
+    
+    df_final = pd.read_parquet(paths[0])
+    X_final = sp.load_npz(paths[1])
+    with np.load(paths[2]) as arrays:
+        T, Y = arrays['T'], arrays['Y']
+    
+    print(f"Loaded cached cohort {key}: N={len(df_final)}")
+    return df_final, X_final, T, Y
+
+def save_cohort_cache(key, df_final, X_final, T, Y):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    base = os.path.join(CACHE_DIR, key)
+    df_final.to_parquet(f"{base}.parquet")
+    sp.save_npz(f"{base}_X.npz", X_final)
+    np.savez(f"{base}_TY.npz", T=T, Y=Y)
+
 # =============================================================================
 # 3. COHORT DEFINITION & SUBSETTING
 # =============================================================================
@@ -85,6 +136,15 @@ def identify_feature_presence(X_sparse, feat_to_idx, concept_ids, prefix_filter=
     if not relevant_cols:
         return np.zeros(X_sparse.shape[0], dtype=bool)
     
+    # Fast path: a single concept column in CSC is just a slice of its row indices
+    if len(relevant_cols) == 1 and X_sparse.format == 'csc':
+        col = relevant_cols[0]
+        start, end = X_sparse.indptr[col], X_sparse.indptr[col + 1]
+        rows = X_sparse.indices[start:end][X_sparse.data[start:end] > 0]
+        mask = np.zeros(X_sparse.shape[0], dtype=bool)
+        mask[rows] = True
+        return mask
+    
     # Sum across relevant columns to find presence
     # Slicing sparse matrix: X[:, cols]
     presence_sum = X_sparse[:, relevant_cols].sum(axis=1)
@@ -111,16 +171,18 @@ def define_predict_trial_cohort(df_cohort, X_sparse, pid_to_idx, feat_to_idx):
     
     # 1. Baseline Kidney Function: eGFR 30-59
     # Using dense column from df_cohort
-    mask_ckd = (df_cohort['baseline_egfr'] >= EGFR_MIN) & (df_cohort['baseline_egfr'] <= EGFR_MAX)
+    egfr = df_cohort['baseline_egfr'].to_numpy()
+    mask_ckd = (egfr >= EGFR_MIN) & (egfr <= EGFR_MAX)
     print(f"  - CKD Stage 3 (eGFR 30-59): {mask_ckd.sum()} patients")
     
+    # Concept lookups are column queries; convert once instead of slicing CSR columns
+    X_csc = X_sparse.tocsc()
+    
     # 2. Diabetes Mellitus (History)
     # Using sparse features
-    has_diabetes = identify_feature_presence(X_sparse, feat_to_idx, DIABETES_ALL, prefix_filter="COND")
-    # Map boolean array back to df_cohort (assuming alignment)
-    df_cohort['has_diabetes'] = has_diabetes
-    mask_diabetes = df_cohort['has_diabetes'] == True
-    print(f"  - Diabetes History: {mask_diabetes.sum()} patients")
+    has_diabetes = identify_feature_presence(X_csc, feat_to_idx, DIABETES_ALL, prefix_filter="COND")
+    # Boolean array is row-aligned with df_cohort; keep it as a plain mask
+    print(f"  - Diabetes History: {has_diabetes.sum()} patients")
     
     # 3. Treatment Identification (Iodixanol vs Iopamidol)
     # Note: We look for these drugs in the sparse matrix (Drug Exposure)
@@ -128,37 +190,36 @@ def define_predict_trial_cohort(df_cohort, X_sparse, pid_to_idx, feat_to_idx):
     # we assume the 'index_date' in df_cohort corresponds to the contrast procedure
     # and we look for the drug record.
     
-    has_iodixanol = identify_feature_presence(X_sparse, feat_to_idx, {IODIXANOL_ID}, prefix_filter="DRUG")
-    has_iopamidol = identify_feature_presence(X_sparse, feat_to_idx, {IOPAMIDOL_ID}, prefix_filter="DRUG")
-    
-    df_cohort['exp_iodixanol'] = has_iodixanol
-    df_cohort['exp_iopamidol'] = has_iopamidol
+    has_iodixanol = identify_feature_presence(X_csc, feat_to_idx, {IODIXANOL_ID}, prefix_filter="DRUG")
+    has_iopamidol = identify_feature_presence(X_csc, feat_to_idx, {IOPAMIDOL_ID}, prefix_filter="DRUG")
+    del X_csc
     
     # Mutually exclusive groups for clean comparison (exclude mixed exposure)
-    mask_iodixanol = (df_cohort['exp_iodixanol']) & (~df_cohort['exp_iopamidol'])
-    mask_iopamidol = (df_cohort['exp_iopamidol']) & (~df_cohort['exp_iodixanol'])
+    # Exactly one of the two exposures <=> XOR
+    mask_exposed = has_iodixanol ^ has_iopamidol
     
-    print(f"  - Iodixanol (Intervention): {mask_iodixanol.sum()} patients")
-    print(f"  - Iopamidol (Comparator): {mask_iopamidol.sum()} patients")
+    print(f"  - Iodixanol (Intervention): {(has_iodixanol & mask_exposed).sum()} patients")
+    print(f"  - Iopamidol (Comparator): {(has_iopamidol & mask_exposed).sum()} patients")
     
     # Combine Filters
-    mask_eligible = mask_ckd & mask_diabetes & (mask_iodixanol | mask_iopamidol)
+    mask_eligible = mask_ckd & has_diabetes & mask_exposed
     
     df_final = df_cohort[mask_eligible].copy()
     
-    # Define Treatment Variable T (1=Iodixanol, 0=Iopamidol)
-    df_final['T'] = df_final['exp_iodixanol'].astype(int)
+    # Define Treatment Variable T (1=Iodixanol, 0=Iopamidol) as int8
+    T = has_iodixanol[mask_eligible].astype(np.int8)
+    n_treated = int(T.sum())
     
     print(f"Final Study Cohort N: {len(df_final)}")
-    print(f"  - Treated (Iodixanol): {df_final['T'].sum()}")
-    print(f"  - Control (Iopamidol): {len(df_final) - df_final['T'].sum()}")
+    print(f"  - Treated (Iodixanol): {n_treated}")
+    print(f"  - Control (Iopamidol): {len(df_final) - n_treated}")
     
     # Slice Sparse Matrix to match filtered cohort
     # Use the tracked original row indices
     subset_indices = df_final['orig_row_idx'].values
     X_final = X_sparse[subset_indices]
     
-    return df_final, X_final
+    return df_final, X_final, T
 
 # =============================================================================
 # 4. OUTCOME DEFINITION
@@ -173,18 +234,21 @@ def define_outcome(df, index_col='index_date', outcome_date_col='date_AKI_30'):
     - If days in [2, 3], Y = 1
     - Else Y = 0
     """
-    # Ensure datetime
-    df[index_col] = pd.to_datetime(df[index_col])
-    df[outcome_date_col] = pd.to_datetime(df[outcome_date_col])
+    # Parquet already stores these as datetimes; take them as numpy arrays
+    # instead of re-parsing with pd.to_datetime
+    index_ns = df[index_col].to_numpy(dtype='datetime64[ns]')
+    outcome_ns = df[outcome_date_col].to_numpy(dtype='datetime64[ns]')
     
-    # Calculate time to event
-    time_to_event = (df[outcome_date_col] - df[index_col]).dt.days
+    # Calculate time to event in whole elapsed days (floored, like .dt.days),
+    # not calendar-day boundaries crossed; NaT dates never fall in the window
+    time_to_event = (outcome_ns - index_ns) // np.timedelta64(1, 'D')
+    has_dates = ~np.isnat(index_ns) & ~np.isnat(outcome_ns)
     
     # Primary Window: 48h to 72h (Days 2 and 3)
     # Note: Day 0 is index. Day 1 is 24h. Day 2 is 48h.
-    mask_window = (time_to_event >= 2) & (time_to_event <= 3)
+    mask_window = has_dates & (time_to_event >= 2) & (time_to_event <= 3)
     
-    Y = mask_window.astype(int).values
+    Y = mask_window.astype(np.int8)
     
     print(f"\nOutcome Definition (AKI within 48-72h):")
     print(f"  - Events: {Y.sum()} ({Y.mean()*100:.2f}%)")
@@ -200,48 +264,77 @@ def fit_lsps_model(X, T):
     Fits Large-Scale Propensity Score (LSPS) using L1-regularized Logistic Regression.
     """
     print("Fitting LSPS Model (L1 Lasso)...")
-    # Using SAGA solver which handles sparse data and L1 penalty efficiently
+    # liblinear (coordinate descent) handles sparse data and L1 penalty
+    # considerably faster than SAGA for binary problems
     model = LogisticRegression(
         penalty='l1',
-        solver='saga',
+        solver='liblinear',
         C=0.1,  # Moderate regularization
         class_weight='balanced',
         max_iter=1000,
-        random_state=RANDOM_STATE,
-        n_jobs=-1
+        random_state=RANDOM_STATE
     )
     model.fit(X, T)
     return model
 
-def calculate_smd(X, T, weights):
+@dataclass
+class SMDContext:
+    """
+    Invariants reused across SMD calls (before/after weighting, covariate subsets).
+    """
+    X: sp.csr_matrix
+    idx_1: np.ndarray
+    idx_0: np.ndarray
+    X_1: sp.csr_matrix
+    X_0: sp.csr_matrix
+    X2_1: sp.csr_matrix
+    X2_0: sp.csr_matrix
+
+    @classmethod
+    def build(cls, X, T):
+        X = sp.csr_matrix(X)
+        idx_1 = np.flatnonzero(T == 1)
+        idx_0 = np.flatnonzero(T == 0)
+        X_1 = X[idx_1]
+        X_0 = X[idx_0]
+
+        # Binary indicator features are their own square: share the arm slices
+        is_binary = X.nnz == 0 or np.all(X.data == 1)
+        if is_binary:
+            X2_1, X2_0 = X_1, X_0
+        else:
+            X2 = X.power(2)
+            X2_1, X2_0 = X2[idx_1], X2[idx_0]
+
+        return cls(
+            X=X,
+            idx_1=idx_1,
+            idx_0=idx_0,
+            X_1=X_1,
+            X_0=X_0,
+            X2_1=X2_1,
+            X2_0=X2_0,
+        )
+
+def calculate_smd(ctx, weights):
     """
     Calculates Standardized Mean Difference (SMD) for sparse data.
     """
-    # Weighted means
-    W = sp.diags(weights)
-    X_w = W @ X
-    
-    # Split by group
-    idx_1 = np.where(T == 1)[0]
-    idx_0 = np.where(T == 0)[0]
-    
-    w_1 = weights[idx_1]
-    w_0 = weights[idx_0]
+    # Split weights by group
+    w_1 = weights[ctx.idx_1]
+    w_0 = weights[ctx.idx_0]
     
     sum_w1 = np.sum(w_1)
     sum_w0 = np.sum(w_0)
     
-    # Means
-    mu_1 = np.array(X_w[idx_1].sum(axis=0) / sum_w1).flatten()
-    mu_0 = np.array(X_w[idx_0].sum(axis=0) / sum_w0).flatten()
+    # Weighted means (row-weighted column sums via sparse mat-vec)
+    mu_1 = (ctx.X_1.T @ w_1) / sum_w1
+    mu_0 = (ctx.X_0.T @ w_0) / sum_w0
     
     # Variances (simplified pooled variance calculation for speed)
     # Var = E[x^2] - E[x]^2
-    X2 = X.power(2)
-    X2_w = W @ X2
-    
-    E_x2_1 = np.array(X2_w[idx_1].sum(axis=0) / sum_w1).flatten()
-    E_x2_0 = np.array(X2_w[idx_0].sum(axis=0) / sum_w0).flatten()
+    E_x2_1 = (ctx.X2_1.T @ w_1) / sum_w1
+    E_x2_0 = (ctx.X2_0.T @ w_0) / sum_w0
     
     var_1 = E_x2_1 - mu_1**2
     var_0 = E_x2_0 - mu_0**2
@@ -267,17 +360,25 @@ def run_cross_fitted_aipw(X, T, Y):
     mu0_preds = np.zeros(len(T))
     ps_preds = np.zeros(len(T))
     
-    for fold, (train_idx, val_idx) in enumerate(skf.split(X, T)):
+    # Precompute per-fold row indices (incl. per-arm training rows) so each
+    # CSR row gather happens once, straight from X
+    folds = []
+    for train_idx, val_idx in skf.split(X, T):
+        T_train = T[train_idx]
+        folds.append((train_idx, val_idx, train_idx[T_train == 0], train_idx[T_train == 1]))
+    
+    for fold, (train_idx, val_idx, train_t0_idx, train_t1_idx) in enumerate(folds):
         print(f"  - Processing Fold {fold+1}/{N_FOLDS}...")
         
         X_train, X_val = X[train_idx], X[val_idx]
         T_train, T_val = T[train_idx], T[val_idx]
-        Y_train, Y_val = Y[train_idx], Y[val_idx]
+        Y_val = Y[val_idx]
         
         # 1. Propensity Score Model (P(T=1|X))
-        ps_model = LogisticRegression(penalty='l1', solver='saga', C=0.1, max_iter=500, class_weight='balanced')
+        ps_model = LogisticRegression(penalty='l1', solver='liblinear', C=0.1, max_iter=500, class_weight='balanced')
         ps_model.fit(X_train, T_train)
-        pi_hat = ps_model.predict_proba(X_val)[:, 1]
+        # P(class 1) directly from the margin; skips the 2-column predict_proba output
+        pi_hat = expit(ps_model.decision_function(X_val))
         
         # Trimming
         pi_hat = np.clip(pi_hat, PS_TRIM_LOW, PS_TRIM_HIGH)
@@ -285,31 +386,45 @@ def run_cross_fitted_aipw(X, T, Y):
         
         # 2. Outcome Models (E[Y|X, T=0] and E[Y|X, T=1])
         # Model for T=0
-        mask_0 = T_train == 0
-        mu0_model = LogisticRegression(penalty='l1', solver='saga', C=0.1, max_iter=500)
-        mu0_model.fit(X_train[mask_0], Y_train[mask_0])
-        mu0_hat = mu0_model.predict_proba(X_val)[:, 1]
+        mu0_model = LogisticRegression(penalty='l1', solver='liblinear', C=0.1, max_iter=500)
+        mu0_model.fit(X[train_t0_idx], Y[train_t0_idx])
+        mu0_hat = expit(mu0_model.decision_function(X_val))
         mu0_preds[val_idx] = mu0_hat
         
         # Model for T=1
-        mask_1 = T_train == 1
-        mu1_model = LogisticRegression(penalty='l1', solver='saga', C=0.1, max_iter=500)
-        mu1_model.fit(X_train[mask_1], Y_train[mask_1])
-        mu1_hat = mu1_model.predict_proba(X_val)[:, 1]
+        mu1_model = LogisticRegression(penalty='l1', solver='liblinear', C=0.1, max_iter=500)
+        mu1_model.fit(X[train_t1_idx], Y[train_t1_idx])
+        mu1_hat = expit(mu1_model.decision_function(X_val))
         mu1_preds[val_idx] = mu1_hat
         
         # 3. Calculate Efficient Influence Function (EIF)
         # EIF = (mu1 - mu0) + T(Y - mu1)/pi - (1-T)(Y - mu0)/(1-pi)
         
-        term1 = mu1_hat - mu0_hat
-        term2 = (T_val * (Y_val - mu1_hat)) / pi_hat
-        term3 = ((1 - T_val) * (Y_val - mu0_hat)) / (1 - pi_hat)
-        
-        eif_values[val_idx] = term1 + term2 - term3
+        if ne is not None:
+            # Single fused loop, no intermediate arrays
+            eif_values[val_idx] = ne.evaluate(
+                "(mu1 - mu0) + T * (Y - mu1) / pi - (1 - T) * (Y - mu0) / (1 - pi)",
+                local_dict={
+                    'mu1': mu1_hat,
+                    'mu0': mu0_hat,
+                    'T': T_val.astype(np.float64),
+                    'Y': Y_val.astype(np.float64),
+                    'pi': pi_hat,
+                },
+            )
+        else:
+            term1 = mu1_hat - mu0_hat
+            term2 = (T_val * (Y_val - mu1_hat)) / pi_hat
+            term3 = ((1 - T_val) * (Y_val - mu0_hat)) / (1 - pi_hat)
+            
+            eif_values[val_idx] = term1 + term2 - term3
 
     # Aggregate Results
+    # Var = E[eif^2] - ate^2; the second moment is a single BLAS dot product
+    n = len(T)
     ate = np.mean(eif_values)
-    se = np.std(eif_values) / np.sqrt(len(T))
+    var = max(np.dot(eif_values, eif_values) / n - ate * ate, 0.0)
+    se = np.sqrt(var / n)
     
     # Risk Ratio Calculation (using mean potential outcomes)
     risk1 = np.mean(mu1_preds)
@@ -389,23 +504,32 @@ def generate_conclusion(results):
 def main():
     print("Starting PREDICT Trial Emulation (SOTAstack Implementation)...")
     
-    # 1. Load Data
+    # 1-3. Load Data, Define Cohort (Eligibility) and Variables
+    # Deterministic given the checkpoint, so reuse a cached result when available
     try:
-        df_cohort, X_sparse, pid_to_idx, feat_to_idx = load_checkpoint_data()
-    except Exception as e:
+        cache_key = cohort_cache_key()
+    except FileNotFoundError as e:
+        print(f"CRITICAL ERROR: Checkpoint files not found. {e}")
         print("Aborting: Data load failed.")
         return
-
-    # 2. Define Cohort (Eligibility)
-    df_final, X_final = define_predict_trial_cohort(df_cohort, X_sparse, pid_to_idx, feat_to_idx)
+    
+    cached = load_cohort_cache(cache_key)
+    if cached is not None:
+        df_final, X_final, T, Y = cached
+    else:
+        try:
+            df_cohort, X_sparse, pid_to_idx, feat_to_idx = load_checkpoint_data()
+        except Exception as e:
+            print("Aborting: Data load failed.")
+            return
+        
+        df_final, X_final, T = define_predict_trial_cohort(df_cohort, X_sparse, pid_to_idx, feat_to_idx)
+        Y = define_outcome(df_final)
+        save_cohort_cache(cache_key, df_final, X_final, T, Y)
     
     if len(df_final) < 100:
         print("CRITICAL: Cohort too small for analysis (<100 patients).")
         return
-
-    # 3. Define Variables
-    T = df_final['T'].values
-    Y = define_outcome(df_final)
     
     # 4. Run Analysis (AIPW)
     results, ps_scores = run_cross_fitted_aipw(X_final, T, Y)
@@ -4,6 +4,8 @@ Generates publication-quality graphs for the VALOR trial target trial emulation.
 """
 
 import numpy as np
+import matplotlib
+matplotlib.use('Agg')  # File output only; skip display backend negotiation
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
 from matplotlib.lines import Line2D
@@ -57,9 +59,15 @@ def create_all_figures():
     create_evalue_plot(ax8)
 
     plt.tight_layout(pad=3.0)
-    plt.savefig('valor_trial_results.png', dpi=150, bbox_inches='tight',
+
+    # Draw once and reuse the tight bbox for both outputs, instead of letting
+    # each savefig(bbox_inches='tight') run its own extra layout pass
+    fig.canvas.draw()
+    bbox = fig.get_tightbbox(fig.canvas.get_renderer()).padded(0.1)
+
+    plt.savefig('valor_trial_results.png', dpi=150, bbox_inches=bbox,
                 facecolor='white', edgecolor='none')
-    plt.savefig('valor_trial_results.svg', format='svg', bbox_inches='tight',
+    plt.savefig('valor_trial_results.svg', format='svg', bbox_inches=bbox,
                 facecolor='white', edgecolor='none')
     print("Saved: valor_trial_results.png and valor_trial_results.svg")
     plt.close()
@@ -285,12 +293,13 @@ def create_km_curve(ax):
     ax.text(0, -2.3, 'Iodixanol', fontsize=8, color='#e74c3c')
     ax.text(0, -3.1, 'Ioversol', fontsize=8, color='#9b59b6')
 
-    for i, h in enumerate([0, 24, 48, 72]):
-        idx = list(hours).index(h)
-        n_iod = 823 - int(iodixanol_ci[idx] * 823 / 100)
-        n_iov = 869 - int(ioversol_ci[idx] * 869 / 100)
-        ax.text(h, -2.3, str(n_iod), fontsize=8, ha='center', color='#e74c3c')
-        ax.text(h, -3.1, str(n_iov), fontsize=8, ha='center', color='#9b59b6')
+    table_hours = np.array([0, 24, 48, 72])
+    idxs = np.searchsorted(hours, table_hours)
+    n_iod = 823 - (iodixanol_ci[idxs] * 823 / 100).astype(int)
+    n_iov = 869 - (ioversol_ci[idxs] * 869 / 100).astype(int)
+    for h, iod, iov in zip(table_hours, n_iod, n_iov):
+        ax.text(h, -2.3, str(iod), fontsize=8, ha='center', color='#e74c3c')
+        ax.text(h, -3.1, str(iov), fontsize=8, ha='center', color='#9b59b6')
 
 
 def create_negative_control_plot(ax):
@@ -338,14 +347,8 @@ def create_evalue_plot(ax):
     """Create E-value sensitivity analysis plot."""
     # E-value calculation for different RR values
     rr_range = np.linspace(0.5, 1.5, 100)
-    e_values = []
-    for rr in rr_range:
-        if rr <= 1:
-            rr_star = 1 / rr
-        else:
-            rr_star = rr
-        e_val = rr_star + np.sqrt(rr_star * (rr_star - 1))
-        e_values.append(e_val)
+    rr_star = np.where(rr_range <= 1, 1 / rr_range, rr_range)
+    e_values = rr_star + np.sqrt(rr_star * (rr_star - 1))
 
     ax.plot(rr_range, e_values, color='#3498db', linewidth=2, label='E-value curve')
 
@@ -1,15 +1,43 @@
-import pandas as pd
 import numpy as np
 import scipy.sparse as sp
+import pyarrow.parquet as pq
 import joblib
+import json
+import os
+import shutil
+import tempfile
 from sklearn.linear_model import LogisticRegression
-from sklearn.ensemble import RandomForestClassifier
+from sklearn.ensemble import HistGradientBoostingClassifier
 from sklearn.model_selection import StratifiedKFold
 from sklearn.base import clone
+from sklearn.utils.class_weight import compute_sample_weight
 from sklearn.preprocessing import StandardScaler
-from scipy.stats import norm
+from scipy.special import ndtr
+from joblib import Parallel, delayed
 import warnings
 import sys
+import re
+import hashlib
+from collections import namedtuple, defaultdict
+from typing import NamedTuple
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    # Plain-Python fallback: kernels run unjitted
+    NUMBA_AVAILABLE = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        def decorator(func):
+            return func
+        return decorator
 
 # Suppress warnings for cleaner output
 warnings.filterwarnings('ignore')
@@ -48,30 +76,86 @@ SEED = 42
 N_FOLDS = 5
 TRIM_QUANTILES = (0.025, 0.975)
 OUTCOME_WINDOW_DAYS = 3  # 48-72h window (approx 3 days)
+MIN_FEATURE_COUNT = 10  # Drop features seen in fewer patients before model fitting
 
 # =============================================================================
 # 2. DATA LOADING & PREPARATION
 # =============================================================================
 
+# Row-major view for model fitting / row gathers, column-major view for
+# concept (column) lookups; both built once at load time
+SparseMatrices = namedtuple('SparseMatrices', ['X_csr', 'X_csc'])
+
+def load_npz_mmap(path):
+    """
+    Loads a CSR/CSC .npz with its arrays memory-mapped read-only.
+    
+    The archive is unpacked to one .npy per array next to the .npz, tagged
+    with the source's size and mtime, and re-unpacked only when those change.
+    Later loads skip the zip decompression, and the full-cohort matrix is
+    backed by the page cache rather than private memory. The CSC view, the
+    eligibility row subsets and everything handed to the fold workers are
+    still ordinary in-RAM copies.
+    """
+    unpacked_dir = os.path.splitext(path)[0] + "_npy"
+    manifest_path = os.path.join(unpacked_dir, "manifest.json")
+    st = os.stat(path)
+    source = {'mtime_ns': st.st_mtime_ns, 'size': st.st_size}
+    
+    manifest = None
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    
+    if manifest is None or manifest['source'] != source:
+        with np.load(path) as npz:
+            fmt = npz['format'].item()
+            fmt = fmt.decode() if isinstance(fmt, bytes) else fmt
+            if fmt not in ('csr', 'csc'):
+                return sp.load_npz(path)
+            # Unpack into a temp dir and rename it into place, so a reader
+            # never sees a half-written set of arrays
+            tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(unpacked_dir) + ".",
+                                       dir=os.path.dirname(os.path.abspath(path)))
+            for name in ('data', 'indices', 'indptr', 'shape'):
+                np.save(os.path.join(tmp_dir, f"{name}.npy"), npz[name])
+        manifest = {'format': fmt, 'source': source}
+        with open(os.path.join(tmp_dir, "manifest.json"), "w") as f:
+            json.dump(manifest, f)
+        if os.path.isdir(unpacked_dir):
+            shutil.rmtree(unpacked_dir)
+        os.rename(tmp_dir, unpacked_dir)
+    
+    arrays = {
+        name: np.load(os.path.join(unpacked_dir, f"{name}.npy"), mmap_mode='r')
+        for name in ('data', 'indices', 'indptr')
+    }
+    shape = tuple(np.load(os.path.join(unpacked_dir, "shape.npy")))
+    matrix_cls = sp.csr_matrix if manifest['format'] == 'csr' else sp.csc_matrix
+    return matrix_cls((arrays['data'], arrays['indices'], arrays['indptr']), shape=shape, copy=False)
+
 def load_checkpoint_data():
     """Loads pre-computed checkpoint files from disk."""
     print("Loading checkpoint data...")
     try:
-        df = pd.read_parquet("df_cohort.parquet")
-        X = sp.load_npz("X_sparse.npz")
+        tbl = pq.read_table("df_cohort.parquet", memory_map=True)
+        df = tbl.to_pandas(split_blocks=True, self_destruct=True)
+        del tbl
+        X = load_npz_mmap("X_sparse.npz")
         pid_map = joblib.load("pid_to_idx.joblib")
         feat_map = joblib.load("feat_to_idx.joblib")
         
         print(f"Loaded df_cohort: {df.shape}")
         print(f"Loaded X_sparse: {X.shape}")
-        return df, X, pid_map, feat_map
+        X_views = SparseMatrices(X_csr=X.tocsr(), X_csc=X.tocsc())
+        return df, X_views, pid_map, feat_map
     except FileNotFoundError as e:
         print(f"CRITICAL ERROR: Checkpoint files not found. {e}")
         sys.exit(1)
 
 def align_sparse_matrix(df_subset, X_full, pid_map):
     """
-    Aligns the sparse matrix to a subset of the cohort dataframe.
+    Aligns the sparse matrices (SparseMatrices) to a subset of the cohort dataframe.
     """
     # Get row indices for the subset
     # pid_map maps person_id -> original row index
@@ -84,19 +168,43 @@ def align_sparse_matrix(df_subset, X_full, pid_map):
         df_subset = df_subset.loc[valid_pids]
         subset_indices = [pid_map[pid] for pid in valid_pids]
 
-    X_subset = X_full[subset_indices, :]
+    X_subset = SparseMatrices(
+        X_csr=X_full.X_csr[subset_indices, :],
+        X_csc=X_full.X_csc[subset_indices, :],
+    )
     return df_subset, X_subset
 
-def identify_treatment_from_sparse(X, feat_map, iodixanol_id, ioversol_id):
+def rows_with_any(X_csc, cols):
+    """
+    Boolean row mask for rows with a positive entry in any of `cols`.
+    Reads only the stored nonzeros of those CSC columns (no dense N x k slice).
+    """
+    mask = np.zeros(X_csc.shape[0], dtype=bool)
+    for col in cols:
+        start, end = X_csc.indptr[col], X_csc.indptr[col + 1]
+        mask[X_csc.indices[start:end][X_csc.data[start:end] > 0]] = True
+    return mask
+
+def build_concept_index(feat_map):
+    """
+    Inverted index concept_id -> feature names, built once at load time.
+    Features are typically named "DRUG_{concept_id}"; every numeric token is indexed.
+    """
+    concept_to_feats = defaultdict(list)
+    for name in feat_map:
+        for token in re.findall(r'\d+', name):
+            concept_to_feats[int(token)].append(name)
+    return concept_to_feats
+
+def identify_treatment_from_sparse(X, feat_map, concept_to_feats, iodixanol_id, ioversol_id):
     """
     Identifies treatment status based on sparse drug features.
     Returns:
         T: Binary array (1=Iodixanol, 0=Ioversol, -1=Excluded)
     """
-    # Find column indices for the drugs
-    # Features are typically named "DRUG_{concept_id}"
-    iodixanol_feats = [f for f in feat_map.keys() if str(iodixanol_id) in f]
-    ioversol_feats = [f for f in feat_map.keys() if str(ioversol_id) in f]
+    # Find column indices for the drugs (O(1) lookups in the concept index)
+    iodixanol_feats = concept_to_feats.get(iodixanol_id, [])
+    ioversol_feats = concept_to_feats.get(ioversol_id, [])
     
     print(f"Found Iodixanol features: {iodixanol_feats}")
     print(f"Found Ioversol features: {ioversol_feats}")
@@ -108,16 +216,17 @@ def identify_treatment_from_sparse(X, feat_map, iodixanol_id, ioversol_id):
     iodixanol_cols = [feat_map[f] for f in iodixanol_feats]
     ioversol_cols = [feat_map[f] for f in ioversol_feats]
     
-    # Sum occurrences (in case of multiple formulations)
-    has_iodixanol = np.array(X[:, iodixanol_cols].sum(axis=1)).flatten() > 0
-    has_ioversol = np.array(X[:, ioversol_cols].sum(axis=1)).flatten() > 0
+    # Any occurrence (in case of multiple formulations)
+    X_csc = X.tocsc()  # no-op for the cached CSC view
+    has_iodixanol = rows_with_any(X_csc, iodixanol_cols)
+    has_ioversol = rows_with_any(X_csc, ioversol_cols)
     
     # Define T
     # T=1: Iodixanol ONLY
     # T=0: Ioversol ONLY
     # Exclude: Both or Neither
     
-    T = np.full(X.shape[0], -1)
+    T = np.full(X.shape[0], -1, dtype=np.int8)
     
     mask_treated = has_iodixanol & (~has_ioversol)
     mask_control = has_ioversol & (~has_iodixanol)
@@ -173,114 +282,235 @@ def apply_eligibility_criteria(df):
 # 4. SOTAstack AIPW IMPLEMENTATION
 # =============================================================================
 
+class AIPWResult(NamedTuple):
+    """Cross-fitted AIPW estimates plus the per-patient PS and trimming mask."""
+    ATE: float
+    SE: float
+    CI_Lower: float
+    CI_Upper: float
+    P_Value: float
+    Risk_1: float
+    Risk_0: float
+    RR: float
+    PS: np.ndarray
+    Keep: np.ndarray
+
 def get_super_learner():
     """
     Returns a simplified SuperLearner-style estimator.
-    Using Random Forest as the primary engine for robustness in this script,
-    as full stacking can be computationally expensive in a single script run.
+    Using histogram gradient boosting as the primary engine: much faster to fit
+    than a random forest and still a consistent outcome learner for AIPW.
+    Requires dense input (see to_dense). Class balancing is passed in as
+    precomputed sample weights.
     """
-    return RandomForestClassifier(
-        n_estimators=100,
-        max_depth=10,
-        min_samples_leaf=10,
-        class_weight='balanced',
-        n_jobs=-1,
+    return HistGradientBoostingClassifier(
+        max_iter=200,
+        max_depth=6,
+        learning_rate=0.05,
+        early_stopping=True,
         random_state=SEED
     )
 
+def to_dense(X):
+    """Densifies a (post-cohort, small) sparse slice as float32 for the outcome learners."""
+    return X.astype(np.float32).toarray()
+
 def get_propensity_model():
     """
     L1 Lasso Logistic Regression for Propensity Score (SOTAstack standard).
+    Class balancing is passed in as precomputed sample weights.
     """
     return LogisticRegression(
         penalty='l1',
         solver='saga',
         C=0.1,
-        class_weight='balanced',
         max_iter=1000,
         n_jobs=-1,
         random_state=SEED
     )
 
+def _fit_fold(fold, train_idx, eval_idx, X, X_dense, T, Y, sw_T, sw_Y, n_folds):
+    """Worker function for a single fold of Cross-Fitting."""
+    print(f"  Processing Fold {fold+1}/{n_folds}...")
+    
+    X_train, X_eval = X[train_idx], X[eval_idx]
+    T_train = T[train_idx]
+    
+    # 1. Propensity Score Model
+    ps_model = get_propensity_model()
+    ps_model.fit(X_train, T_train, sample_weight=sw_T[train_idx])
+    pi_chunk = ps_model.predict_proba(X_eval)[:, 1]
+    
+    # Trimming happens once on the assembled PS vector (see crump_trim_bounds)
+    
+    # 2. Outcome Models (row slices of the shared dense matrix)
+    X_eval_dense = X_dense[eval_idx]
+    
+    # Mu0: Train on Control (T=0)
+    train_t0_idx = train_idx[T_train == 0]
+    mu0_model = get_super_learner()
+    mu0_model.fit(X_dense[train_t0_idx], Y[train_t0_idx], sample_weight=sw_Y[train_t0_idx])
+    mu0_chunk = mu0_model.predict_proba(X_eval_dense)[:, 1]
+    
+    # Mu1: Train on Treated (T=1)
+    train_t1_idx = train_idx[T_train == 1]
+    mu1_model = get_super_learner()
+    mu1_model.fit(X_dense[train_t1_idx], Y[train_t1_idx], sample_weight=sw_Y[train_t1_idx])
+    mu1_chunk = mu1_model.predict_proba(X_eval_dense)[:, 1]
+    
+    return eval_idx, pi_chunk, mu0_chunk, mu1_chunk
+
+@njit(parallel=True, cache=True)
+def _aipw_eif(T, Y, mu0, mu1, pi):
+    """
+    Single pass over the cohort: per-patient EIF plus its first two moments.
+    psi = (mu1 - mu0) + T(Y-mu1)/pi - (1-T)(Y-mu0)/(1-pi)
+    Returns (ate, se, eif); eif is float32, the moments accumulate in float64.
+    """
+    n = T.shape[0]
+    eif = np.empty(n, dtype=np.float32)
+    s = 0.0
+    ss = 0.0
+    for i in prange(n):
+        m1 = np.float64(mu1[i])
+        m0 = np.float64(mu0[i])
+        p = np.float64(pi[i])
+        e = (m1 - m0) + T[i] * (Y[i] - m1) / p - (1 - T[i]) * (Y[i] - m0) / (1 - p)
+        eif[i] = e
+        s += e
+        ss += e * e
+    ate = s / n
+    var = max(ss / n - ate * ate, 0.0)
+    return ate, np.sqrt(var / n), eif
+
+@njit(parallel=True, cache=True)
+def _fold_clustered_se(eif, ate, fold_id, n_folds):
+    """
+    CRV1 standard error of mean(eif), clustering on the cross-fitting fold:
+    V = G/(G-1) * sum_g (sum_{i in g} (eif_i - ate))^2 / n^2.
+    One thread per fold; each only writes its own score slot.
+    """
+    n = eif.shape[0]
+    scores = np.zeros(n_folds)
+    for g in prange(n_folds):
+        acc = 0.0
+        for i in range(n):
+            if fold_id[i] == g:
+                acc += np.float64(eif[i]) - ate
+        scores[g] = acc
+    var = n_folds / (n_folds - 1) * np.sum(scores * scores) / (n * n)
+    return np.sqrt(var)
+
+def crump_trim_bounds(ps):
+    """
+    Adaptive PS trimming bounds (Crump et al., 2009), never looser than TRIM_QUANTILES.
+    
+    alpha solves 1/(alpha(1-alpha)) = 2 E[g | g <= 1/(alpha(1-alpha))], g = 1/(ps(1-ps)).
+    One sort + cumulative mean over g, computed once on the assembled PS vector.
+    """
+    # float64 and clipped: a float32 PS that rounds to exactly 0 or 1 would make
+    # g inf, and inf > inf would silently skip the adaptive bounds
+    ps = np.clip(np.asarray(ps, dtype=np.float64), 1e-6, 1.0 - 1e-6)
+    g = 1.0 / (ps * (1.0 - ps))
+    alpha = 0.0
+    if g.max() > 2.0 * g.mean():
+        g_sorted = np.sort(g)
+        cum_mean = np.cumsum(g_sorted) / np.arange(1, len(g_sorted) + 1)
+        # Last point before g overtakes twice its running conditional mean
+        k = np.argmax(g_sorted > 2.0 * cum_mean) - 1
+        gamma = 2.0 * cum_mean[max(k, 0)]
+        alpha = 0.5 - np.sqrt(max(0.25 - 1.0 / gamma, 0.0))
+    return max(alpha, TRIM_QUANTILES[0]), min(1.0 - alpha, TRIM_QUANTILES[1])
+
 def run_cross_fitted_aipw(X, T, Y, n_folds=5):
     """
     Performs Cross-Fitted AIPW estimation.
     """
-    print(f"\nRunning {n_folds}-Fold Cross-Fitted AIPW...")
+    print(f"\nRunning {n_folds}-Fold Cross-Fitted AIPW in PARALLEL...")
     
     kf = StratifiedKFold(n_splits=n_folds, shuffle=True, random_state=SEED)
     n = len(T)
     
-    mu0_hat = np.zeros(n)
-    mu1_hat = np.zeros(n)
-    pi_hat = np.zeros(n)
-    eif_val = np.zeros(n)
-    
-    # For diagnostics
-    ps_models = []
+    # Drop rare features once, before the fold loop: L1 would zero them anyway,
+    # and they dominate SAGA's per-iteration cost on the wide sparse matrix
+    X = sp.csr_matrix(X)
+    col_nnz = np.bincount(X.indices, minlength=X.shape[1])
+    X = X[:, col_nnz >= MIN_FEATURE_COUNT]
+    print(f"  Features with >= {MIN_FEATURE_COUNT} occurrences: {X.shape[1]} / {len(col_nnz)}")
+    
+    # Densify once for the outcome learners; every fold and both arms slice
+    # rows from this (joblib memory-maps it into the workers)
+    X_dense = to_dense(X)
+    
+    # 'balanced' class weights computed once instead of inside every .fit():
+    # on T for the PS model, and on Y within each arm for the outcome models
+    sw_T = compute_sample_weight('balanced', T)
+    sw_Y = np.empty(n)
+    for t in (0, 1):
+        arm = T == t
+        sw_Y[arm] = compute_sample_weight('balanced', Y[arm])
+    
+    # float32 is ample for predicted probabilities; reductions promote to float64
+    mu0_hat = np.zeros(n, dtype=np.float32)
+    mu1_hat = np.zeros(n, dtype=np.float32)
+    pi_hat = np.zeros(n, dtype=np.float32)
+    
+    # Precompute fold indices once; int32 halves the index size for the CSR row gathers
+    folds = [
+        (train_idx.astype(np.int32), eval_idx.astype(np.int32))
+        for train_idx, eval_idx in kf.split(np.zeros(n), T)
+    ]
+    fold_id = np.empty(n, dtype=np.int8)
+    for fold, (_, eval_idx) in enumerate(folds):
+        fold_id[eval_idx] = fold
+    
+    # Folds are independent: one process per fold (loky caps each worker's
+    # OpenMP threads, so the boosting models do not oversubscribe)
+    fold_results = Parallel(n_jobs=min(n_folds, os.cpu_count() or 1), backend='loky')(
+        delayed(_fit_fold)(fold, train_idx, eval_idx, X, X_dense, T, Y, sw_T, sw_Y, n_folds)
+        for fold, (train_idx, eval_idx) in enumerate(folds)
+    )
     
-    for fold, (train_idx, eval_idx) in enumerate(kf.split(X, T)):
-        print(f"  Processing Fold {fold+1}/{n_folds}...")
-        
-        X_train, X_eval = X[train_idx], X[eval_idx]
-        T_train, T_eval = T[train_idx], T[eval_idx]
-        Y_train, Y_eval = Y[train_idx], Y[eval_idx]
-        
-        # 1. Propensity Score Model
-        ps_model = get_propensity_model()
-        ps_model.fit(X_train, T_train)
-        pi_chunk = ps_model.predict_proba(X_eval)[:, 1]
-        
-        # Trimming
-        pi_chunk = np.clip(pi_chunk, TRIM_QUANTILES[0], TRIM_QUANTILES[1])
-        pi_hat[eval_idx] = pi_chunk
-        
-        # 2. Outcome Models
-        # Mu0: Train on Control (T=0)
-        mu0_model = get_super_learner()
-        mu0_model.fit(X_train[T_train == 0], Y_train[T_train == 0])
-        mu0_chunk = mu0_model.predict_proba(X_eval)[:, 1]
-        mu0_hat[eval_idx] = mu0_chunk
-        
-        # Mu1: Train on Treated (T=1)
-        mu1_model = get_super_learner()
-        mu1_model.fit(X_train[T_train == 1], Y_train[T_train == 1])
-        mu1_chunk = mu1_model.predict_proba(X_eval)[:, 1]
-        mu1_hat[eval_idx] = mu1_chunk
-        
-        # 3. EIF Calculation (Doubly Robust)
-        # psi = (mu1 - mu0) + T(Y-mu1)/pi - (1-T)(Y-mu0)/(1-pi)
-        term1 = mu1_chunk - mu0_chunk
-        term2 = (T_eval * (Y_eval - mu1_chunk)) / pi_chunk
-        term3 = ((1 - T_eval) * (Y_eval - mu0_chunk)) / (1 - pi_chunk)
-        
-        eif_val[eval_idx] = term1 + term2 - term3
-        
-    # Inference
-    ate = np.mean(eif_val)
-    se = np.std(eif_val) / np.sqrt(n)
+    for eval_idx, pi_chunk, mu0_chunk, mu1_chunk in fold_results:
+        pi_hat[eval_idx] = pi_chunk.astype(np.float32, copy=False)
+        mu0_hat[eval_idx] = mu0_chunk.astype(np.float32, copy=False)
+        mu1_hat[eval_idx] = mu1_chunk.astype(np.float32, copy=False)
+    
+    # Trimming: drop (rather than clip) patients outside the overlap region,
+    # since clipping biases the estimate at the boundary
+    trim_low, trim_high = crump_trim_bounds(pi_hat)
+    keep = (pi_hat >= trim_low) & (pi_hat <= trim_high)
+    print(f"  PS trimming to [{trim_low:.3f}, {trim_high:.3f}]: dropped {n - keep.sum()} patients")
+    
+    # EIF Calculation (Doubly Robust) + Inference
+    ate, se_iid, eif_val = _aipw_eif(T[keep], Y[keep], mu0_hat[keep], mu1_hat[keep], pi_hat[keep])
+    # Nuisance models are shared within a fold, so cluster the variance on it.
+    # With only n_folds clusters CRV1 is itself noisy: never report less than the iid SE
+    se_crv1 = _fold_clustered_se(eif_val, ate, fold_id[keep], n_folds)
+    se = max(se_iid, se_crv1)
     z_score = ate / se if se > 0 else 0
-    p_value = 2 * (1 - norm.cdf(np.abs(z_score)))
+    p_value = 2 * (1 - ndtr(np.abs(z_score)))
     
     ci_lower = ate - 1.96 * se
     ci_upper = ate + 1.96 * se
     
     # Risk Ratio (derived from marginal means)
-    risk_1 = np.mean(mu1_hat)
-    risk_0 = np.mean(mu0_hat)
+    risk_1 = np.mean(mu1_hat[keep], dtype=np.float64)
+    risk_0 = np.mean(mu0_hat[keep], dtype=np.float64)
     rr = risk_1 / risk_0 if risk_0 > 0 else np.nan
     
-    results = {
-        'ATE': ate,
-        'SE': se,
-        'CI_Lower': ci_lower,
-        'CI_Upper': ci_upper,
-        'P_Value': p_value,
-        'Risk_1': risk_1,
-        'Risk_0': risk_0,
-        'RR': rr,
-        'PS': pi_hat
-    }
+    results = AIPWResult(
+        ATE=ate,
+        SE=se,
+        CI_Lower=ci_lower,
+        CI_Upper=ci_upper,
+        P_Value=p_value,
+        Risk_1=risk_1,
+        Risk_0=risk_0,
+        RR=rr,
+        PS=pi_hat,
+        Keep=keep
+    )
     
     return results
 
@@ -288,50 +518,172 @@ def run_cross_fitted_aipw(X, T, Y, n_folds=5):
 # 5. DIAGNOSTICS
 # =============================================================================
 
+@njit(parallel=True, cache=True)
+def _iptw_weight_sums(T, ps):
+    """(sum w, sum w^2) of IPTW weights in one pass, without materializing w."""
+    sum_w = 0.0
+    sum_w2 = 0.0
+    for i in prange(T.shape[0]):
+        # Branchless: the PS of the received arm is 1 - ps + T*(2ps - 1)
+        w = 1.0 / (1.0 - ps[i] + T[i] * (2.0 * ps[i] - 1.0))
+        sum_w += w
+        sum_w2 += w * w
+    return sum_w, sum_w2
+
+# Reusable work arrays for the NumPy diagnostics paths, grown on demand, so
+# repeated calls (bootstrap / sensitivity loops) do not reallocate per call
+_SCRATCH = {}
+
+def _scratch(name, n, dtype=np.float64):
+    buf = _SCRATCH.get((name, dtype))
+    if buf is None or buf.shape[0] < n:
+        buf = _SCRATCH[(name, dtype)] = np.empty(n, dtype=dtype)
+    return buf[:n]
+
+def _iptw_weight_sums_vectorized(T, ps):
+    """
+    NumPy form of _iptw_weight_sums for when numba is unavailable (the
+    unjitted loop is far slower). Same branchless form as the kernel, built
+    in one reused buffer with no boolean masks.
+    """
+    w = np.multiply(ps, 2.0, out=_scratch('weights', ps.shape[0], ps.dtype.type))
+    w -= 1.0
+    w *= T
+    w += 1.0
+    w -= ps
+    np.reciprocal(w, out=w)
+    # float64 accumulators: np.dot on the float32 buffer would sum in float32
+    return w.sum(dtype=np.float64), np.einsum('i,i->', w, w, dtype=np.float64)
+
+def _array_digest(a):
+    """Content hash of an array's bytes, used as a cache key."""
+    buf = np.ascontiguousarray(a).view(np.uint8)
+    if xxhash is not None:
+        return xxhash.xxh3_64_intdigest(buf)
+    return hashlib.blake2b(buf, digest_size=16).digest()
+
+# Sensitivity sweeps re-run the diagnostics on an unchanged cohort / PS vector.
+# Overlap + ESS depend only on (T, ps) and SMD only on (X, T), so each piece
+# is memoized on its own inputs (oldest entry evicted first)
+_PS_DIAGNOSTICS_CACHE = {}
+_SMD_CACHE = {}
+DIAGNOSTICS_CACHE_SIZE = 64
+
+def _memoized(cache, key, func, *args):
+    result = cache.get(key)
+    if result is None:
+        result = func(*args)
+        if len(cache) >= DIAGNOSTICS_CACHE_SIZE:
+            cache.pop(next(iter(cache)))
+        cache[key] = result
+    return result
+
 def calculate_diagnostics(X, T, ps):
     """Calculates SMD, ESS, and Overlap."""
     print("\nCalculating Diagnostics...")
     
-    # 1. Effective Sample Size (ESS)
-    p_t = T.mean()
-    weights = np.where(T == 1, 1/ps, 1/(1-ps))
-    ess = (np.sum(weights) ** 2) / np.sum(weights ** 2)
-    ess_ratio = ess / len(T)
+    # Diagnostics are reported to 3 decimals: fp32 PS halves the bandwidth of
+    # the ESS / overlap reductions (scalar results are still fp64)
+    ps = np.asarray(ps, dtype=np.float32)
+    T = np.asarray(T, dtype=np.int8)
+    t_key = _array_digest(T)
+    ess, overlap = _memoized(_PS_DIAGNOSTICS_CACHE, (t_key, _array_digest(ps)), _ess_and_overlap, T, ps)
     
-    # 2. Overlap Coefficient
-    # Simple histogram overlap
-    hist1, _ = np.histogram(ps[T==1], bins=20, range=(0,1), density=True)
-    hist0, _ = np.histogram(ps[T==0], bins=20, range=(0,1), density=True)
-    overlap = np.sum(np.minimum(hist1, hist0)) * (1/20)
+    # The SMD key hashes X's full CSR contents: covariate-subset sweeps pass
+    # different matrices that can share a shape and nnz
+    X = sp.csr_matrix(X)
+    x_key = (X.shape, _array_digest(X.data), _array_digest(X.indices), _array_digest(X.indptr))
+    max_smd = _memoized(_SMD_CACHE, (x_key, t_key), _max_smd, X, T)
     
-    # 3. Sparse SMD (Simplified for top features)
-    # Calculate unweighted means
-    mean_1 = np.array(X[T==1].mean(axis=0)).flatten()
-    mean_0 = np.array(X[T==0].mean(axis=0)).flatten()
-    var_1 = np.array(X[T==1].var(axis=0)).flatten()
-    var_0 = np.array(X[T==0].var(axis=0)).flatten()
-    
-    pooled_sd = np.sqrt((var_1 + var_0) / 2)
-    pooled_sd[pooled_sd == 0] = 1e-6
-    
-    smds = np.abs(mean_1 - mean_0) / pooled_sd
-    max_smd = np.max(smds)
-    mean_smd = np.mean(smds)
-    
-    print(f"  ESS: {ess:.1f} (Ratio: {ess_ratio:.3f})")
+    print(f"  ESS: {ess:.1f} (Ratio: {ess / len(T):.3f})")
     print(f"  Overlap Coefficient: {overlap:.3f}")
     print(f"  Max Unadjusted SMD: {max_smd:.3f}")
     
     return {'ESS': ess, 'Overlap': overlap, 'Max_SMD': max_smd}
 
+def _ess_and_overlap(T, ps):
+    # 1. Effective Sample Size (ESS)
+    weight_sums = _iptw_weight_sums if NUMBA_AVAILABLE else _iptw_weight_sums_vectorized
+    sum_w, sum_w2 = weight_sums(T, ps)
+    ess = float(sum_w * sum_w / sum_w2)
+    
+    # 2. Overlap Coefficient
+    # Simple histogram overlap: 20 fixed bins on [0, 1], so quantize ps once
+    # and count both arms with bincount instead of two np.histogram passes
+    # (ps == 1.0 lands in bin 20: clip to 19, as np.histogram's closed last bin)
+    bin_idx = np.clip((ps * 20).astype(np.int32), 0, 19)
+    hist1 = np.bincount(bin_idx, weights=T, minlength=20)
+    hist0 = np.bincount(bin_idx, minlength=20) - hist1
+    # density=True equivalent: divide counts by (total * bin width)
+    hist1 /= hist1.sum() * (1/20)
+    hist0 /= hist0.sum() * (1/20)
+    overlap = np.sum(np.minimum(hist1, hist0, out=hist1)) * (1/20)
+    
+    return ess, overlap
+
+def _max_smd(X, T):
+    # 3. Sparse SMD (Simplified for top features)
+    # Unweighted per-arm moments from sparse mat-vecs on X and X**2,
+    # without slicing X into per-arm sub-matrices
+    X = sp.csr_matrix(X)
+    # Empty columns have SMD 0 and cannot set the max: keep only features seen
+    # in this cohort, so every dense per-feature vector below is that width
+    X = X[:, np.flatnonzero(np.bincount(X.indices, minlength=X.shape[1]))]
+    if X.shape[1] == 0:
+        return 0.0
+    X_sq = X.power(2)
+    t1 = T.astype(np.float64)
+    t0 = 1.0 - t1
+    n1 = t1.sum()
+    n0 = t0.sum()
+    mean_1 = (t1 @ X) / n1
+    mean_0 = (t0 @ X) / n0
+    var_1 = np.maximum((t1 @ X_sq) / n1 - mean_1 * mean_1, 0.0)
+    var_0 = np.maximum((t0 @ X_sq) / n0 - mean_0 * mean_0, 0.0)
+    
+    # Zero-variance features are constant within each arm: their SMD is 0 when
+    # the arms agree and only the 1e-6 floor bounds it when they separate
+    # perfectly, so settle them up front and divide over the rest
+    zero_var = (var_1 + var_0) <= 0
+    separated_max = np.max(np.abs(mean_1[zero_var] - mean_0[zero_var]), initial=0.0) / 1e-6
+    active = ~zero_var
+    mean_1, mean_0, var_1, var_0 = mean_1[active], mean_0[active], var_1[active], var_0[active]
+    
+    if NUMBA_AVAILABLE:
+        return max(_smd_max(mean_1, mean_0, var_1, var_0), separated_max)
+    
+    p = mean_1.shape[0]
+    pooled_sd = np.add(var_1, var_0, out=_scratch('pooled_sd', p))
+    pooled_sd *= 0.5
+    np.sqrt(pooled_sd, out=pooled_sd)
+    np.maximum(pooled_sd, 1e-6, out=pooled_sd)
+    
+    smds = np.subtract(mean_1, mean_0, out=_scratch('mean_diff', p))
+    np.abs(smds, out=smds)
+    smds /= pooled_sd
+    return max(np.max(smds, initial=0.0), separated_max)
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _smd_max(mean_1, mean_0, var_1, var_0):
+    """Max |SMD| in one streaming pass: pooled SD, 1e-6 floor, divide and max fused."""
+    max_smd = 0.0
+    for j in prange(mean_1.shape[0]):
+        sd = max(np.sqrt((var_1[j] + var_0[j]) * 0.5), 1e-6)
+        max_smd = max(max_smd, abs(mean_1[j] - mean_0[j]) / sd)
+    return max_smd
+
 def calculate_e_value(rr):
-    """Calculates E-Value for Risk Ratio."""
-    if pd.isna(rr) or rr <= 0: return 1.0
-    if rr <= 1:
-        rr_star = 1 / rr
-    else:
-        rr_star = rr
-    return rr_star + np.sqrt(rr_star * (rr_star - 1))
+    """
+    Calculates E-Value for Risk Ratio.
+    Accepts a scalar or an array of RRs (e.g. bootstrap draws); NaN or
+    non-positive RRs map to 1.0.
+    """
+    rr = np.asarray(rr, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rr_star = np.where(rr <= 1, 1.0 / rr, rr)
+        e_value = rr_star + np.sqrt(rr_star * (rr_star - 1))
+    e_value = np.where(rr > 0, e_value, 1.0)
+    return e_value.item() if e_value.ndim == 0 else e_value
 
 # =============================================================================
 # 6. MAIN PIPELINE
@@ -341,7 +693,8 @@ def main():
     print("=== STARTING VALOR TRIAL EMULATION (SOTAstack) ===")
     
     # 1. Load Data
-    df_cohort, X_sparse, pid_to_idx, feat_to_idx = load_checkpoint_data()
+    df_cohort, X_views, pid_to_idx, feat_to_idx = load_checkpoint_data()
+    concept_to_feats = build_concept_index(feat_to_idx)
     
     # 2. Apply Eligibility Criteria (VALOR: CKD + Coronary Angio)
     df_eligible = apply_eligibility_criteria(df_cohort)
@@ -351,18 +704,18 @@ def main():
         return
 
     # 3. Align Sparse Matrix
-    df_aligned, X_aligned = align_sparse_matrix(df_eligible, X_sparse, pid_to_idx)
+    df_aligned, X_aligned = align_sparse_matrix(df_eligible, X_views, pid_to_idx)
     
     # 4. Define Treatment (Iodixanol vs Ioversol)
     # Using sparse features to identify specific drugs
     T_full = identify_treatment_from_sparse(
-        X_aligned, feat_to_idx, IODIXANOL_CONCEPT_ID, IOVERSOL_CONCEPT_ID
+        X_aligned.X_csc, feat_to_idx, concept_to_feats, IODIXANOL_CONCEPT_ID, IOVERSOL_CONCEPT_ID
     )
     
     # Filter to rows where Treatment is defined (0 or 1)
     mask_valid_t = T_full != -1
     df_final = df_aligned[mask_valid_t].copy()
-    X_final = X_aligned[mask_valid_t]
+    X_final = X_aligned.X_csr[mask_valid_t]
     T_final = T_full[mask_valid_t]
     
     print(f"\nFinal Analysis Cohort N: {len(df_final)}")
@@ -377,9 +730,16 @@ def main():
     # Using date_AKI_30 as proxy for event, checking window
     # Y=1 if AKI date is within [index, index + 3 days]
     if 'date_AKI_30' in df_final.columns:
-        days_to_aki = (df_final['date_AKI_30'] - df_final['index_date']).dt.days
-        Y_final = ((days_to_aki >= 0) & (days_to_aki <= OUTCOME_WINDOW_DAYS)).astype(int).values
-        print(f"  Outcome Events (CIN/AKI <= {OUTCOME_WINDOW_DAYS}d): {sum(Y_final)} ({sum(Y_final)/len(Y_final):.2%})")
+        # int64 nanosecond views: floor division matches Timedelta.days without
+        # building a Timedelta Series; NaT dates are masked out explicitly
+        aki_ns = df_final['date_AKI_30'].to_numpy(dtype='datetime64[ns]')
+        index_ns = df_final['index_date'].to_numpy(dtype='datetime64[ns]')
+        days_to_aki = (aki_ns.view('i8') - index_ns.view('i8')) // np.int64(86_400_000_000_000)
+        Y_final = (
+            (days_to_aki >= 0) & (days_to_aki <= OUTCOME_WINDOW_DAYS)
+            & ~np.isnat(aki_ns) & ~np.isnat(index_ns)
+        ).astype(np.int8)
+        print(f"  Outcome Events (CIN/AKI <= {OUTCOME_WINDOW_DAYS}d): {Y_final.sum()} ({Y_final.mean():.2%})")
     else:
         print("CRITICAL: Outcome column 'date_AKI_30' not found.")
         return
@@ -388,8 +748,10 @@ def main():
     results = run_cross_fitted_aipw(X_final, T_final, Y_final, n_folds=N_FOLDS)
     
     # 7. Diagnostics
-    diag = calculate_diagnostics(X_final, T_final, results['PS'])
-    e_value = calculate_e_value(results['RR'])
+    # Diagnostics on the trimmed analysis population
+    keep = results.Keep
+    diag = calculate_diagnostics(X_final[keep], T_final[keep], results.PS[keep])
+    e_value = calculate_e_value(results.RR)
     
     # 8. Regulatory Conclusion
     print("\n" + "="*60)
@@ -399,15 +761,15 @@ def main():
     print(f"Population: N={len(df_final)} (Active={np.sum(T_final==1)}, Comp={np.sum(T_final==0)})")
     print(f"Outcome: CIN/AKI within {OUTCOME_WINDOW_DAYS} days")
     print("-" * 60)
-    print(f"Risk Difference (ATE): {results['ATE']:.4f} (95% CI: {results['CI_Lower']:.4f}, {results['CI_Upper']:.4f})")
-    print(f"Risk Ratio (RR):       {results['RR']:.4f}")
-    print(f"P-Value:               {results['P_Value']:.4f}")
+    print(f"Risk Difference (ATE): {results.ATE:.4f} (95% CI: {results.CI_Lower:.4f}, {results.CI_Upper:.4f})")
+    print(f"Risk Ratio (RR):       {results.RR:.4f}")
+    print(f"P-Value:               {results.P_Value:.4f}")
     print(f"E-Value:               {e_value:.2f}")
     print("-" * 60)
     
     # Interpretation Logic
-    if results['P_Value'] < 0.05:
-        if results['ATE'] < 0:
+    if results.P_Value < 0.05:
+        if results.ATE < 0:
             conclusion = "EVIDENCE OF BENEFIT: Iodixanol is associated with significantly lower risk of CIN compared to Ioversol."
         else:
             conclusion = "EVIDENCE OF HARM: Iodixanol is associated with significantly higher risk of CIN compared to Ioversol."
@@ -417,7 +779,7 @@ def main():
     print(f"CONCLUSION: {conclusion}")
     
     # Diagnostic Warnings
-    if diag['ESS'] / len(df_final) < 0.2:
+    if diag['ESS'] / keep.sum() < 0.2:
         print("WARNING: Low Effective Sample Size. Propensity overlap may be poor.")
     if diag['Overlap'] < 0.1:
         print("WARNING: Poor Propensity Score Overlap. Results rely on extrapolation.")
@@ -4,35 +4,143 @@ FastAPI server for Virtual Clinical Trial Agent
 Exposes the agent pipeline as REST API endpoints
 """
 
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, JSONResponse
 from pydantic import BaseModel
 from typing import Optional, Dict, List
 import uvicorn
+import asyncio
+from contextlib import asynccontextmanager
+import hashlib
 import json
+import mmap
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 from pathlib import Path
 
 from agent.main import run_pipeline
 
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class ORJSONResponse(JSONResponse):
+    """JSON response encoded with orjson (FastAPI's own ORJSONResponse is deprecated)"""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+def new_pipeline_pool() -> ProcessPoolExecutor:
+    """Worker processes for run_pipeline, started with spawn (forking a threaded server is unsafe)"""
+    max_workers = int(os.environ.get("TRIAL_WORKERS", os.cpu_count() or 1))
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Startup/shutdown of app-wide resources"""
+    # Trials run in worker processes so CPU-bound steps never block the event loop
+    app.state.pipeline_pool = new_pipeline_pool()
+    refresh_examples_cache()
+    try:
+        yield
+    finally:
+        app.state.pipeline_pool.shutdown(wait=False, cancel_futures=True)
+
+
 app = FastAPI(
     title="Virtual Clinical Trial API",
     description="API for running virtual clinical trials using AI agents",
     version="1.0.0",
+    lifespan=lifespan,
+    # orjson serializes the (multi-MB) example payloads several times faster
+    default_response_class=ORJSONResponse if orjson is not None else JSONResponse,
 )
 
 # Configure CORS for frontend
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["http://localhost:5173", "http://localhost:3000", "http://localhost:8080"],  # Vite ports
+    allow_origin_regex=r"^http://localhost:(5173|3000|8080)$",  # Vite ports
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    max_age=86400,  # let browsers cache preflight responses for a day
 )
 
-# In-memory storage for run status (use Redis/DB in production)
-run_status: Dict[str, dict] = {}
+class RunStatusStore:
+    """
+    Registry of trial runs.
+
+    Backed by Redis (one hash per run, expiring after ttl_seconds) when
+    REDIS_URL is set, so every uvicorn worker sees the same runs and old
+    entries are evicted. Falls back to process memory for local development.
+    """
+
+    KEY_PREFIX = "trial:"
+
+    def __init__(self, redis_url: Optional[str] = None, ttl_seconds: int = 86400):
+        self.ttl_seconds = ttl_seconds
+        self._memory: Dict[str, dict] = {}
+        self._redis = None
+        if redis_url:
+            if aioredis is None:
+                raise RuntimeError("REDIS_URL is set but the 'redis' package is not installed")
+            # from_url keeps a connection pool shared by all requests
+            self._redis = aioredis.from_url(redis_url, decode_responses=True)
+
+    def _key(self, run_id: str) -> str:
+        return f"{self.KEY_PREFIX}{run_id}"
+
+    async def update(self, run_id: str, **fields):
+        """Create or update fields of a run (None values are not stored)"""
+        fields = {"run_id": run_id, **{k: v for k, v in fields.items() if v is not None}}
+        if self._redis is None:
+            self._memory.setdefault(run_id, {}).update(fields)
+            return
+        key = self._key(run_id)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping=fields)
+            pipe.expire(key, self.ttl_seconds)
+            await pipe.execute()
+
+    async def get(self, run_id: str) -> Optional[dict]:
+        if self._redis is None:
+            return self._memory.get(run_id)
+        trial = await self._redis.hgetall(self._key(run_id))
+        return trial or None
+
+    async def delete(self, run_id: str) -> bool:
+        if self._redis is None:
+            return self._memory.pop(run_id, None) is not None
+        return await self._redis.delete(self._key(run_id)) > 0
+
+    async def list(self) -> List[dict]:
+        if self._redis is None:
+            return list(self._memory.values())
+        # SCAN pages through the keyspace instead of blocking Redis like KEYS
+        keys = [key async for key in self._redis.scan_iter(match=f"{self.KEY_PREFIX}*", count=100)]
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.hgetall(key)
+            trials = await pipe.execute()
+        return [trial for trial in trials if trial]
+
+
+run_status = RunStatusStore(
+    redis_url=os.environ.get("REDIS_URL"),
+    ttl_seconds=int(os.environ.get("RUN_STATUS_TTL_SECONDS", 86400)),
+)
 
 
 class TrialRequest(BaseModel):
@@ -70,26 +178,71 @@ class TrialResultResponse(BaseModel):
     validator_feedback: Optional[str] = None
 
 
-def run_trial_background(run_id: str, question: str):
+# Output files written by run_pipeline, by result field
+TRIAL_ARTIFACTS = {
+    "causal_question": "step1_causal_question.txt",
+    "design_spec": "step2_design_spec.md",
+    "code": "step3_code.py",
+    "omop_mappings": "step2c_omop_mappings.md",
+    "validator_feedback": "step2_validator_feedback.txt",
+}
+
+
+def read_artifact(path: Path) -> Optional[str]:
+    """Read a text artifact through mmap, letting the page cache serve repeat reads"""
+    if not path.exists():
+        return None
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ""
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return bytes(mm).decode("utf-8")
+
+
+def artifacts_etag(run_id: str, run_folder: Path) -> str:
+    """ETag over the artifacts' mtimes and sizes (stat calls only, no reads)"""
+    signature = [run_id]
+    for filename in TRIAL_ARTIFACTS.values():
+        path = run_folder / filename
+        if path.exists():
+            st = path.stat()
+            signature.append(f"{filename}:{st.st_mtime_ns}:{st.st_size}")
+    digest = hashlib.blake2b("|".join(signature).encode(), digest_size=8).hexdigest()
+    return f'"{digest}"'
+
+
+async def run_trial_background(run_id: str, question: str):
     """Background task to run the trial pipeline"""
     try:
-        run_status[run_id]["status"] = "running"
+        await run_status.update(run_id, status="running")
 
-        # Run the pipeline
-        run_folder = run_pipeline(question)
+        # Run the pipeline in a separate process; this coroutine only waits on it
+        loop = asyncio.get_running_loop()
+        pool = app.state.pipeline_pool
+        try:
+            run_folder = await loop.run_in_executor(pool, run_pipeline, question)
+        except BrokenProcessPool:
+            # A crashed worker breaks the whole pool: replace it (once, if
+            # several trials see the same breakage) so later trials still run
+            if app.state.pipeline_pool is pool:
+                app.state.pipeline_pool = new_pipeline_pool()
+                pool.shutdown(wait=False, cancel_futures=True)
+            raise
 
         # Update status
-        run_status[run_id].update({
-            "status": "completed",
-            "run_folder": run_folder,
-            "completed_at": datetime.utcnow().isoformat(),
-        })
+        await run_status.update(
+            run_id,
+            status="completed",
+            run_folder=run_folder,
+            completed_at=datetime.utcnow().isoformat(),
+        )
     except Exception as e:
-        run_status[run_id].update({
-            "status": "failed",
-            "error": str(e),
-            "completed_at": datetime.utcnow().isoformat(),
-        })
+        await run_status.update(
+            run_id,
+            status="failed",
+            error=str(e),
+            completed_at=datetime.utcnow().isoformat(),
+        )
 
 
 @app.get("/")
@@ -114,12 +267,12 @@ async def create_trial(request: TrialRequest, background_tasks: BackgroundTasks)
     run_id = f"run_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}"
 
     # Initialize run status
-    run_status[run_id] = {
-        "run_id": run_id,
-        "status": "queued",
-        "question": request.question,
-        "created_at": datetime.utcnow().isoformat(),
-    }
+    await run_status.update(
+        run_id,
+        status="queued",
+        question=request.question,
+        created_at=datetime.utcnow().isoformat(),
+    )
 
     # Start background task
     background_tasks.add_task(run_trial_background, run_id, request.question)
@@ -134,66 +287,94 @@ async def create_trial(request: TrialRequest, background_tasks: BackgroundTasks)
 @app.get("/api/trials/{run_id}/status", response_model=TrialStatusResponse)
 async def get_trial_status(run_id: str):
     """Get the status of a running or completed trial"""
-    if run_id not in run_status:
+    trial = await run_status.get(run_id)
+    if trial is None:
         raise HTTPException(status_code=404, detail="Trial not found")
 
-    return TrialStatusResponse(**run_status[run_id])
+    return TrialStatusResponse(**trial)
 
 
 @app.get("/api/trials/{run_id}/results", response_model=TrialResultResponse)
-async def get_trial_results(run_id: str):
+async def get_trial_results(run_id: str, request: Request, response: Response):
     """Get the results of a completed trial"""
-    if run_id not in run_status:
+    trial = await run_status.get(run_id)
+    if trial is None:
         raise HTTPException(status_code=404, detail="Trial not found")
 
-    trial = run_status[run_id]
-
     if trial["status"] != "completed":
         raise HTTPException(
             status_code=400,
             detail=f"Trial is {trial['status']}. Results only available for completed trials.",
         )
 
-    run_folder = trial["run_folder"]
+    run_folder = Path(trial["run_folder"])
 
-    # Read all output files
-    def read_file(filename: str) -> Optional[str]:
-        path = Path(run_folder) / filename
-        if path.exists():
-            return path.read_text()
-        return None
+    # Completed results only change if their files do: answer polls with a
+    # 304 without reading or re-encoding anything
+    etag = artifacts_etag(run_id, run_folder)
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
 
+    # Read all output files
     return TrialResultResponse(
         run_id=run_id,
         question=trial["question"],
-        causal_question=read_file("step1_causal_question.txt"),
-        design_spec=read_file("step2_design_spec.md"),
-        code=read_file("step3_code.py"),
-        omop_mappings=read_file("step2c_omop_mappings.md"),
-        validator_feedback=read_file("step2_validator_feedback.txt"),
+        **{field: read_artifact(run_folder / filename) for field, filename in TRIAL_ARTIFACTS.items()},
     )
 
 
+@app.get("/api/trials/{run_id}/artifact/{name}")
+async def get_trial_artifact(run_id: str, name: str):
+    """Stream a single output file of a completed trial (e.g. name=code)"""
+    trial = await run_status.get(run_id)
+    if trial is None:
+        raise HTTPException(status_code=404, detail="Trial not found")
+
+    if trial["status"] != "completed":
+        raise HTTPException(
+            status_code=400,
+            detail=f"Trial is {trial['status']}. Results only available for completed trials.",
+        )
+
+    if name not in TRIAL_ARTIFACTS:
+        raise HTTPException(status_code=404, detail=f"Unknown artifact: {name}")
+
+    path = Path(trial["run_folder"]) / TRIAL_ARTIFACTS[name]
+    if not path.exists():
+        raise HTTPException(status_code=404, detail=f"Artifact {name} not found")
+
+    return FileResponse(path, media_type="text/plain")
+
+
 @app.get("/api/trials", response_model=List[TrialStatusResponse])
 async def list_trials():
     """List all trials"""
-    return [TrialStatusResponse(**trial) for trial in run_status.values()]
+    return [TrialStatusResponse(**trial) for trial in await run_status.list()]
 
 
 @app.delete("/api/trials/{run_id}")
 async def delete_trial(run_id: str):
     """Delete a trial from the registry"""
-    if run_id not in run_status:
+    if not await run_status.delete(run_id):
         raise HTTPException(status_code=404, detail="Trial not found")
 
-    del run_status[run_id]
     return {"message": f"Trial {run_id} deleted successfully"}
 
 
-@app.get("/api/examples")
-async def get_example_trials():
-    """Get list of example trials with their data"""
-    examples_dir = Path(__file__).parent / "run" / "example-for-website"
+EXAMPLES_DIR = Path(__file__).parent / "run" / "example-for-website"
+
+
+def examples_mtime() -> float:
+    """Latest modification time under EXAMPLES_DIR (stat calls only, no reads)"""
+    if not EXAMPLES_DIR.exists():
+        return 0.0
+    return max((p.stat().st_mtime for p in EXAMPLES_DIR.rglob("*")), default=0.0)
+
+
+def load_example_trials() -> List[dict]:
+    """Scan EXAMPLES_DIR and load every example trial's data, code and image names"""
+    examples_dir = EXAMPLES_DIR
 
     if not examples_dir.exists():
         return []
@@ -211,8 +392,11 @@ async def get_example_trials():
         json_file = json_files[0]
 
         try:
-            with open(json_file, 'r') as f:
-                trial_data = json.load(f)
+            if orjson is not None:
+                trial_data = orjson.loads(json_file.read_bytes())
+            else:
+                with open(json_file, 'r') as f:
+                    trial_data = json.load(f)
 
             # Read Python code if exists
             code_file = trial_dir / "trial_code.py"
@@ -235,6 +419,21 @@ async def get_example_trials():
     return examples
 
 
+def refresh_examples_cache():
+    app.state.examples_mtime = examples_mtime()
+    app.state.examples_cache = load_example_trials()
+
+
+@app.get("/api/examples")
+async def get_example_trials():
+    """Get list of example trials with their data"""
+    # Served from memory; rescanned only when a file under EXAMPLES_DIR changes
+    # (or on first use, if the app was started without its lifespan)
+    if getattr(app.state, "examples_cache", None) is None or examples_mtime() > app.state.examples_mtime:
+        refresh_examples_cache()
+    return app.state.examples_cache
+
+
 if __name__ == "__main__":
     uvicorn.run(
         "server:app",
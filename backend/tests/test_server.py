@@ -0,0 +1,47 @@
+"""Smoke tests for the FastAPI trial endpoints."""
+
+import sys
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import server  # noqa: E402
+
+
+@pytest.fixture
+def client(monkeypatch):
+    # Fresh in-memory store, and no pipeline run behind the background task
+    monkeypatch.setattr(server, "run_status", server.RunStatusStore())
+
+    async def skip_pipeline(run_id, question):
+        return None
+
+    monkeypatch.setattr(server, "run_trial_background", skip_pipeline)
+    return TestClient(server.app)
+
+
+def test_create_trial_then_get_status(client):
+    response = client.post("/api/trials", json={"question": "Does drug A reduce AKI?"})
+    assert response.status_code == 200
+    run_id = response.json()["run_id"]
+    assert response.json()["status"] == "queued"
+
+    response = client.get(f"/api/trials/{run_id}/status")
+    assert response.status_code == 200
+    status = response.json()
+    assert status["run_id"] == run_id
+    assert status["status"] == "queued"
+    assert status["question"] == "Does drug A reduce AKI?"
+
+
+def test_unknown_trial_is_404(client):
+    assert client.get("/api/trials/run_missing/status").status_code == 404
+
+
+def test_examples_served_without_lifespan(client):
+    response = client.get("/api/examples")
+    assert response.status_code == 200
+    assert isinstance(response.json(), list)